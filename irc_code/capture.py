@@ -0,0 +1,82 @@
+"""
+Compact binary traffic log of the server, used by `replay.py`.
+
+Layout: MAGIC, then one record per event:
+    <timestamp us: u64> <connection id: u32> <kind: u8> <length: u16> <payload: length bytes>
+
++ CONNECT: a client was accepted, payload empty.
++ DATA: raw bytes of one recv() from the client.
++ SENT: the server sent `length` bytes to the client, payload not stored.
++ CLOSE: the server dropped the client after an orderly shutdown or QUIT, payload empty.
++ RESET: the server dropped the client after a socket error (e.g. connection reset), payload empty.
+
+Timestamps are microseconds since the capture started.
+"""
+
+import time
+import struct
+
+MAGIC = b'IRCCAP1\n'
+RECORD = struct.Struct('<QIBH')
+
+CONNECT, DATA, SENT, CLOSE, RESET = range(5)
+
+class CaptureWriter:
+    """ Appends records for the connections of one server run. """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = time.perf_counter()
+        self.next_id = 0
+        # Capture id of each live client socket.
+        self.ids = {}
+
+    def _write(self, sock, kind, length=0, payload=b''):
+        ts = int((time.perf_counter() - self.start) * 1e6)
+        self.file.write(RECORD.pack(ts, self.ids[sock], kind, length))
+        if payload:
+            self.file.write(payload)
+
+    def connect(self, sock):
+        self.ids[sock] = self.next_id
+        self.next_id += 1
+        self._write(sock, CONNECT)
+
+    def data(self, sock, payload):
+        self._write(sock, DATA, len(payload), payload)
+
+    def sent(self, sock, length):
+        if sock in self.ids:
+            self._write(sock, SENT, length)
+
+    def disconnect(self, sock, reset=False):
+        if sock in self.ids:
+            self._write(sock, RESET if reset else CLOSE)
+            del self.ids[sock]
+
+    def flush(self):
+        """ Push buffered records to disk, so a killed server loses at most one loop iteration. """
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """ Yield (timestamp seconds, connection id, kind, payload) for each record. SENT payload is its length. """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not an irc capture file')
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            ts, conn_id, kind, length = RECORD.unpack(header)
+            if kind == SENT:
+                payload = length
+            elif length:
+                payload = f.read(length)
+            else:
+                payload = b''
+            yield ts / 1e6, conn_id, kind, payload
@@ -2,6 +2,9 @@
 SERVER SIDE IMPLEMENTATION 
 """
 
+import os
+import errno
+import signal
 import socket
 import sys, time
 import argparse
@@ -10,15 +13,23 @@ import threading
 import logging
 import view
 import common
-import select
+import selectors
+from array import array
+import profiling
+import capture
 
 logging.basicConfig(filename='view.log', level=logging.DEBUG)
 logger = logging.getLogger()
 
+# Seconds to stop accepting after running out of file descriptors, unless a client leaves first.
+ACCEPT_BACKOFF = 0.1
+
 """
 Class represents an user in the server.
 """
 class user:
+    __slots__ = ('registered', 'addr', 'username', 'nickname', 'channel')
+
     def __init__(self, addr):
         self.registered = False
         self.addr = addr
@@ -40,18 +51,73 @@ class user:
         self.registered = hasattr(self, 'username') and hasattr(self, 'nickname') and hasattr(self, 'channel')
         return self.registered
 
+"""
+Class represents a connection that has not finished NICK/USER/JOIN yet.
+Kept apart from `user` so a reconnect storm of half-registered clients stays cheap.
+"""
+class pending_registration:
+    __slots__ = ('addr', 'nickname', 'username', 'channel')
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.nickname = None
+        self.username = None
+        self.channel = None
+
+    def set_username(self, username):
+        self.username = username
+
+    def set_nickname(self, nickname):
+        self.nickname = nickname
+
+    def join_channel(self, channel):
+        self.channel = channel
+
+    def check_registered(self):
+        return self.username is not None and self.nickname is not None and self.channel is not None
+
 """
 Class represents the server.
 """
 class IRCServer():
     server_socket = socket.socket()
-    online_users = []
-    SOCKET_LIST = []
 
-    def __init__(self, HOST, PORT):
+    def __init__(self, HOST, PORT, backlog=socket.SOMAXCONN, max_per_ip=0, profile_dir='.', capture_path=None):
         """ Initialize the server """
         self.HOST, self.PORT = HOST, PORT
         self.ADDR = (self.HOST, self.PORT)
+        self.backlog = backlog
+        # 0 means no limit on concurrent connections from one IP.
+        self.max_per_ip = max_per_ip
+        self.refused_connections = 0
+        # While out of file descriptors the listening socket is unregistered, a level-triggered
+        # selector would otherwise wake up for the queued backlog forever. None while accepting.
+        self.accept_resume_at = None
+        # True from the first failed accept until one succeeds again, to warn once per episode.
+        self.accept_starved = False
+
+        self.selector = selectors.DefaultSelector()
+        # Peer address of each client socket, captured at accept time and indexed by fd:
+        # port (0 for a free slot) and IPv4 address packed as an int.
+        self.peer_ports = array('H')
+        self.peer_ips = array('I')
+        # Keyed by packed IPv4 address.
+        self.connections_per_ip = {}
+        # Every recv() lands in this one buffer, so idle connections hold no buffer of their own.
+        self.recv_buffer = bytearray(common.HEADER_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+        # Registered users and connections that have not completed NICK/USER/JOIN, keyed by addr.
+        self.online_users = {}
+        self.pending_users = {}
+        # addr of every nickname taken, by registered and pending users alike.
+        self.nicknames = {}
+
+        self.profiler = profiling.Profiler(self, profile_dir)
+        # Thread running the event loop, the one the sampling profiler samples.
+        self.loop_thread_id = None
+
+        # Records inbound traffic for `replay.py` when a capture file is given.
+        self.capture = capture.CaptureWriter(capture_path) if capture_path else None
 
         # Create and bind the server socket with the provided address.
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -63,70 +129,221 @@ class IRCServer():
 
     def start(self):
         """ Method to start the server and listen to connections incoming from clients. """
-        self.server_socket.listen()
-        logger.info('[SERVER] Actively listening for connection')
+        self.server_socket.listen(self.backlog)
+        logger.info(f'[SERVER] Actively listening for connection (backlog {self.backlog})')
         print('[SERVER] Actively listening for connection')
 
-        self.SOCKET_LIST.append(self.server_socket)
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.loop_thread_id = threading.get_ident()
 
         while True:
-            ready_to_read, _, _ = select.select(self.SOCKET_LIST, [], [], 0)
-
-            for sock in ready_to_read:
-                # New connection request.
+            timeout = None
+            if self.accept_resume_at is not None:
+                timeout = max(self.accept_resume_at - time.monotonic(), 0)
+            for key, _ in self.selector.select(timeout):
+                sock = key.fileobj
+                # New connection request(s).
                 if sock is self.server_socket:
-                    sockfd, addr = self.server_socket.accept()
-                    self.SOCKET_LIST.append(sockfd)
-                    logger.info(f'\n[SERVER] Received and accepted new connection from [{addr}]')
-                    print(f'\n[SERVER] Received and accepted new connection from [{addr}]')
+                    self.accept_connections()
+
+                # An admin command typed on the server console.
+                elif sock is sys.stdin:
+                    self.handle_console()
 
                 # A message from client to server
                 else:
                     try:
-                        data = sock.recv(common.HEADER_SIZE).decode(common.ENCODE_FORMAT)
-                        if data:
-                            self.handle_data(sock, data)
-                        else:
-                            logger.debug('Broken Socket. Removing')
-                            if sock in self.SOCKET_LIST:
-                                self.SOCKET_LIST.remove(sock)
-                                self.remove_user(int(sock.getpeername()[1]))
-                    except:
+                        raw = self.recv_view[:sock.recv_into(self.recv_buffer)]
+                    except OSError:
                         logger.info(f'[SERVER] A client disconnected from the server')
                         print(f'[SERVER] A client disconnected from the server')
+                        self.drop_connection(sock, reset=True)
                         self.broadcast(sock, f'A client walked out of the server')
                         continue
+                    if not raw:
+                        logger.debug('Broken Socket. Removing')
+                        self.drop_connection(sock)
+                        continue
+                    if self.capture is not None:
+                        self.capture.data(sock, raw)
+                    # A malformed message must not cost the client its connection.
+                    try:
+                        self.handle_data(sock, str(raw, common.ENCODE_FORMAT))
+                    except Exception:
+                        logger.exception(f'[SERVER] Failed to handle a message, ignoring it')
+
+            if self.accept_resume_at is not None and time.monotonic() >= self.accept_resume_at:
+                self.resume_accepting()
+            if self.capture is not None:
+                self.capture.flush()
         self.server_socket.close()
 
+    def accept_connections(self):
+        """ Accept every connection waiting in the backlog, not just one per wakeup. """
+        accepted = 0
+        while True:
+            try:
+                sockfd, addr = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                if self.accept_starved:
+                    # Backlog drained, the shortage is over.
+                    self.accept_starved = False
+                    logger.warning(f'[SERVER] Accepting connections again')
+                break
+            except OSError as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # Out of file descriptors, leave the rest queued in the backlog for a while.
+                    self.pause_accepting(e)
+                else:
+                    logger.warning(f'[SERVER] Failed to accept connection: {e}')
+                break
+
+            ip = int.from_bytes(socket.inet_aton(addr[0]), 'big')
+            if self.max_per_ip and self.connections_per_ip.get(ip, 0) >= self.max_per_ip:
+                logger.debug(f'[SERVER] Refused [{addr}]: too many connections from {addr[0]}')
+                sockfd.close()
+                self.refused_connections += 1
+                continue
+
+            self.connections_per_ip[ip] = self.connections_per_ip.get(ip, 0) + 1
+            self.track_peer(sockfd.fileno(), ip, addr[1])
+            self.selector.register(sockfd, selectors.EVENT_READ)
+            if self.capture is not None:
+                self.capture.connect(sockfd)
+            logger.debug(f'[SERVER] Received and accepted new connection from [{addr}]')
+            accepted += 1
+
+        if accepted:
+            logger.info(f'[SERVER] Accepted {accepted} new connection(s)')
+
+    def pause_accepting(self, error):
+        """ Stop watching the listening socket for ACCEPT_BACKOFF seconds, or until a client leaves. """
+        if not self.accept_starved:
+            self.accept_starved = True
+            logger.warning(f'[SERVER] Failed to accept connection: {error}, pausing accept')
+            print(f'[SERVER] Out of file descriptors, pausing accept')
+        self.selector.unregister(self.server_socket)
+        self.accept_resume_at = time.monotonic() + ACCEPT_BACKOFF
+
+    def resume_accepting(self):
+        self.accept_resume_at = None
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+    def enable_admin_console(self):
+        """
+        Read profiling commands (see `profiling.Profiler.handle_command`) from stdin, only when it
+        is the terminal of a foreground server.
+        """
+        # Bytes of a console line not terminated yet.
+        self.console_buffer = b''
+        if isinstance(self.selector, selectors.SelectSelector):
+            # Windows select() only takes sockets: registering stdin works, the first select() fails.
+            reason = 'the selector cannot watch stdin on this platform'
+        elif sys.stdin is None or not sys.stdin.isatty():
+            reason = 'stdin is not a terminal'
+        elif not self.in_foreground():
+            # A background process reading its terminal gets stopped by SIGTTIN.
+            reason = 'the server is not in the foreground'
+        else:
+            reason = None
+        if reason is not None:
+            logger.info(f'[SERVER] Admin console unavailable: {reason}')
+            print(f'[SERVER] Admin console unavailable: {reason}')
+            return
+        if hasattr(signal, 'SIGTTIN'):
+            # Moved to the background later (Ctrl-Z, bg), a read fails with EIO instead of stopping the server.
+            signal.signal(signal.SIGTTIN, signal.SIG_IGN)
+        self.selector.register(sys.stdin, selectors.EVENT_READ)
+
+    def in_foreground(self):
+        """ Whether this process is the foreground process group of its terminal. """
+        try:
+            return os.getpgrp() == os.tcgetpgrp(sys.stdin.fileno())
+        except (AttributeError, OSError):
+            return False
+
+    def handle_console(self):
+        # Read the fd directly: sys.stdin buffers lines the selector would not report again.
+        try:
+            chunk = os.read(sys.stdin.fileno(), 4096)
+        except OSError as e:
+            # e.g. EIO once the server is in the background, handled like a closed stdin.
+            logger.warning(f'[SERVER] Admin console read failed: {e}')
+            chunk = b''
+        if not chunk:
+            # stdin closed, run what is left and stop watching it.
+            self.selector.unregister(sys.stdin)
+            chunk = b'\n'
+        *lines, self.console_buffer = (self.console_buffer + chunk).split(b'\n')
+        for line in lines:
+            self.profiler.handle_command(line.decode(common.ENCODE_FORMAT, 'replace'))
+
+    def track_peer(self, fd, ip, port):
+        """ Store the peer address of fd, growing the fd-indexed arrays when needed. """
+        if fd >= len(self.peer_ports):
+            grow = max(fd + 1, 2 * len(self.peer_ports)) - len(self.peer_ports)
+            self.peer_ports.extend([0] * grow)
+            self.peer_ips.extend([0] * grow)
+        self.peer_ports[fd] = port
+        self.peer_ips[fd] = ip
+
+    def client_count(self):
+        """ Number of connected clients. """
+        return sum(self.connections_per_ip.values())
+
+    def peer_port(self, sock):
+        """ Port of the peer, 0 if the socket is not a tracked client. """
+        fd = sock.fileno()
+        return self.peer_ports[fd] if 0 <= fd < len(self.peer_ports) else 0
+
+    def drop_connection(self, sock, reset=False):
+        """ Forget a client socket, its profile and its per-IP slot. """
+        port = self.peer_port(sock)
+        if not port:
+            return
+        fd = sock.fileno()
+        ip = self.peer_ips[fd]
+        self.peer_ports[fd] = 0
+        if self.capture is not None:
+            self.capture.disconnect(sock, reset)
+        self.selector.unregister(sock)
+        remaining = self.connections_per_ip[ip] - 1
+        if remaining:
+            self.connections_per_ip[ip] = remaining
+        else:
+            del self.connections_per_ip[ip]
+        self.remove_user(port)
+        sock.close()
+        if self.accept_resume_at is not None:
+            # A descriptor just got free, retry accepting on the next loop iteration.
+            self.accept_resume_at = time.monotonic()
+
     def remove_user(self, addr):
         """ Remove a connection out of online users list """
-        for each in self.online_users:
-            if each.addr == addr:
-                self.online_users.remove(each)
+        profile = self.pending_users.pop(addr, None) or self.online_users.pop(addr, None)
+        if profile is not None and self.nicknames.get(profile.nickname) == addr:
+            del self.nicknames[profile.nickname]
 
 
     """
     Handle the received data from a client.
     """
     def handle_data(self, conn, msg):
-        addr = int(conn.getpeername()[1])
+        addr = self.peer_port(conn)
 
         logger.info(f'[SERVER] received [{addr}] : {msg} ')
         print(f'[SERVER] received [{addr}] : {msg}')
 
-        # Check if current client profile was already created.
-        profile_existed = any(u.addr == addr for u in self.online_users)
-
         if(msg.startswith('NICK ')): 
-            self.handle_NICK(conn, addr, msg, profile_existed)
+            self.handle_NICK(conn, addr, msg)
             return
 
         if(msg.startswith('USER ')): 
-            self.handle_USER(conn, addr, msg, profile_existed)
+            self.handle_USER(conn, addr, msg)
             return
             
         if(msg.startswith('JOIN ')): 
-            self.handle_JOIN(conn, addr, msg, profile_existed)
+            self.handle_JOIN(conn, addr, msg)
             return
 
         if(msg.startswith('QUIT')): 
@@ -144,16 +361,29 @@ class IRCServer():
     def broadcast(self, conn, msg, to_all=False):
         logger.debug(f'[SERVER] Broadcasting {msg}')
         print(f'[SERVER] Broadcasting {msg}')
-        for sock in self.SOCKET_LIST:
-            if (sock is not self.server_socket) and ((sock is not conn) or to_all):
-                sock.send(bytes(msg, common.ENCODE_FORMAT))
+        # The selector already holds every live client socket.
+        for key in self.selector.get_map().values():
+            sock = key.fileobj
+            if (sock is not self.server_socket) and (sock is not sys.stdin) and ((sock is not conn) or to_all):
+                try:
+                    sent = sock.send(bytes(msg, common.ENCODE_FORMAT))
+                    if self.capture is not None:
+                        self.capture.sent(sock, sent)
+                except OSError:
+                    # Dead peer, it gets removed on its own next read.
+                    logger.debug(f'[SERVER] Skipped broadcasting to a broken socket')
 
     """
     Close all openning sockets.
     """
     def close(self):
-        for s in self.SOCKET_LIST:
-            s.close()
+        self.profiler.stop_all()
+        if self.capture is not None:
+            self.capture.close()
+        for key in list(self.selector.get_map().values()):
+            if key.fileobj is not sys.stdin:
+                key.fileobj.close()
+        self.server_socket.close()
         logger.info(f'[SERVER] Successfully closed all opening sockets')
         print(f'[SERVER] Successfully closed all opening sockets')
 
@@ -161,67 +391,77 @@ class IRCServer():
     Set of functions to handle requests from client to server in RFC 1459 format
     """
 
-    def handle_NICK(self, conn, addr, msg, profile_existed):
+    def handle_NICK(self, conn, addr, msg):
         """ Format: NICK nickname """
         nickname = msg[len('NICK '):]
 
         duplicated = self.duplicate_NICK(addr, nickname)
         if duplicated:
             # Send error status back to client.
-            conn.send(bytes(common.NICKNAMEINUSE, common.ENCODE_FORMAT))
+            sent = conn.send(bytes(common.NICKNAMEINUSE, common.ENCODE_FORMAT))
+            if self.capture is not None:
+                self.capture.sent(conn, sent)
             logger.info(f'[SERVER] [{addr}] Nick name is in use. Try another one')
             self.remove_user(addr)
             return
 
-        if profile_existed:
-            for each_user in self.online_users:
-                if each_user.addr == addr:
-                    each_user.set_nickname(nickname)
-                    logger.info(f'[SERVER] [{addr}] Successfully set nickname')
-                    return
-
-        new_user = user(addr)
-        new_user.set_nickname(nickname)
-        self.online_users.append(new_user)
+        profile = self.find_profile(addr)
+        if self.nicknames.get(profile.nickname) == addr:
+            # Renamed, release the old nickname.
+            del self.nicknames[profile.nickname]
+        profile.set_nickname(nickname)
+        self.nicknames[nickname] = addr
+        self.complete_registration(profile)
         logger.info(f'[SERVER] [{addr}] Successfully set nickname')
 
     def duplicate_NICK(self, addr, nickname):
         """ Check if a nickname existed in server """
-        return any(u.nickname == nickname and u.addr is not addr for u in self.online_users)
+        return self.nicknames.get(nickname, addr) != addr
 
-    def handle_USER(self, conn, addr, msg, profile_existed):
+    def handle_USER(self, conn, addr, msg):
         """ Format: USER username hostname servername realname """
         username = msg.split(' ')[1]
 
-        if profile_existed:
-            for each_user in self.online_users:
-                if each_user.addr == addr:
-                    each_user.set_username(username)
-                    logger.info(f'[SERVER] [{addr}] Successfully set username')
-                    return
-
-        new_user = user(int(addr))
-        new_user.set_username(username)
-        self.online_users.append(new_user)
+        profile = self.find_profile(addr)
+        profile.set_username(username)
+        self.complete_registration(profile)
         logger.info(f'[SERVER] [{addr}] Successfully set username')
 
-    def handle_JOIN(self, conn, addr, msg, profile_existed):
+    def handle_JOIN(self, conn, addr, msg):
         """ Format: JOIN #global """
-        channel = msg[len('JOIN '):]
-
-        if profile_existed:
-            for each_user in self.online_users:
-                if each_user.addr == addr:
-                    each_user.join_channel(channel)
-                    logger.info(f'[SERVER] [{addr}] Successfully join the channel {channel}')
-                    if each_user.check_registered():
-                        self.broadcast(conn, self.PRIVMSG('SERVER', f'Welcome {each_user.nickname} to our amazing channel'), True)
-                    return
-
-        new_user = user(addr)
-        new_user.join_channel(channel)
-        self.online_users.append(new_user)
+        # Every member shares one copy of the channel name.
+        channel = sys.intern(msg[len('JOIN '):])
+
+        profile = self.find_profile(addr)
+        profile.join_channel(channel)
+        profile = self.complete_registration(profile)
         logger.info(f'[SERVER] [{addr}] Successfully join the channel {channel}')
+        if profile.check_registered():
+            self.broadcast(conn, self.PRIVMSG('SERVER', f'Welcome {profile.nickname} to our amazing channel'), True)
+
+    def find_profile(self, addr):
+        """ Return the registered user for addr, or its pending registration (created on first use). """
+        if addr in self.pending_users:
+            return self.pending_users[addr]
+        if addr in self.online_users:
+            return self.online_users[addr]
+        profile = self.pending_users[addr] = pending_registration(addr)
+        return profile
+
+    def complete_registration(self, profile):
+        """ Promote a pending registration to a full user once NICK, USER and JOIN are all in. """
+        if not isinstance(profile, pending_registration) or not profile.check_registered():
+            return profile
+        del self.pending_users[profile.addr]
+        if not self.pending_users:
+            # A dict keeps its table at peak size, clear() hands it back after a connection storm.
+            self.pending_users.clear()
+        new_user = user(profile.addr)
+        new_user.set_nickname(profile.nickname)
+        new_user.set_username(profile.username)
+        new_user.join_channel(profile.channel)
+        self.online_users[new_user.addr] = new_user
+        return new_user
 
     def handle_PRIVMSG(self, conn, msg):
         sender, _, content = common.extract_message(msg)
@@ -233,15 +473,15 @@ class IRCServer():
 
     def handle_QUIT(self, conn, addr, msg):
         """ Format: QUIT :reason """
-        self.SOCKET_LIST.remove(conn)
-        self.remove_user(addr)
+        username = self.find_username(addr)
+        self.drop_connection(conn)
         logger.info(f'[SERVER] received a QUIT request from [{addr}]')
-        self.broadcast(conn, str(self.find_username(addr) + ' ' + msg.split(':', 1)[1]))
+        self.broadcast(conn, f'{username} {msg.split(":", 1)[1]}')
 
     def find_username(self, addr):
-        for each in self.online_users:
-            if each.addr == addr:
-                return each.username
+        profile = self.pending_users.get(addr) or self.online_users.get(addr)
+        if profile is not None:
+            return profile.username
     """
     End of domain
     """
@@ -249,14 +489,19 @@ class IRCServer():
 def main(args):
     HOST = ''
     PORT = args.port
+    server = IRCServer(HOST, PORT, args.backlog, args.max_per_ip, args.profile_dir, args.capture)
+    # SIGTERM (kill, service managers) goes through the same cleanup as Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
     try:
-        server = IRCServer(HOST, PORT)
+        server.profiler.install_signal_handlers()
+        if args.admin_console:
+            server.enable_admin_console()
         server.start()
     except KeyboardInterrupt:
         logger.info(f'[SERVER] Keyboard interrupted server. Server is terminating')
         print(f'[SERVER] Keyboard interrupted server. Server is terminating')
+    finally:
         server.close()
-        sys.exit()
 
 if __name__ == '__main__':
     # create parser object
@@ -267,6 +512,25 @@ if __name__ == '__main__':
                         metavar="PORT", default=5050,
                         help="Target port to use")
 
+    parser.add_argument("-b", "--backlog", type=int, nargs="?",
+                        metavar="BACKLOG", default=socket.SOMAXCONN,
+                        help="Length of the pending connection queue")
+
+    parser.add_argument("-m", "--max-per-ip", type=int, nargs="?",
+                        metavar="MAX_PER_IP", default=0,
+                        help="Max concurrent connections from one IP (0 for no limit)")
+
+    parser.add_argument("--profile-dir", type=str, nargs="?",
+                        metavar="PROFILE_DIR", default=".",
+                        help="Directory for profiler and tracemalloc output")
+
+    parser.add_argument("--capture", type=str, nargs="?",
+                        metavar="CAPTURE_FILE", default=None,
+                        help="Record inbound client traffic to this file for replay.py")
+
+    parser.add_argument("--admin-console", action="store_true",
+                        help="Read profiling commands from the terminal (foreground server only)")
+
     # parse the arguments from standard input
     args = parser.parse_args()
     print(args)
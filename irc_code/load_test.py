@@ -0,0 +1,70 @@
+"""
+Connection storm load test: reconnect many clients at once and report connects/sec.
+"""
+
+import socket
+import threading
+import time
+import argparse
+
+import irc_server
+
+def storm(server, clients, timeout):
+    """
+    Open `clients` connections as fast as possible and wait until the server accepted or
+    refused (per-IP cap) every one of them, or `timeout` seconds passed.
+    """
+    addr = ('127.0.0.1', server.server_socket.getsockname()[1])
+    conns = []
+    start = time.perf_counter()
+    for _ in range(clients):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.connect(addr)
+        conns.append(conn)
+    deadline = start + timeout
+    while accepted(server) + server.refused_connections < clients and time.perf_counter() < deadline:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    return conns, elapsed
+
+def accepted(server):
+    return server.client_count()
+
+def main(args):
+    server = irc_server.IRCServer('127.0.0.1', 0, args.backlog, args.max_per_ip)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    while server.loop_thread_id is None:
+        time.sleep(0.01)
+
+    conns, elapsed = storm(server, args.clients, args.timeout)
+    handled = accepted(server) + server.refused_connections
+    print(f'[LOAD TEST] {handled}/{args.clients} connections handled in {elapsed:.3f}s '
+          f'({handled / elapsed:.0f} connects/sec): {accepted(server)} accepted, '
+          f'{server.refused_connections} refused')
+    if handled < args.clients:
+        print(f'[LOAD TEST] Gave up after {args.timeout}s, {args.clients - handled} still pending')
+    for conn in conns:
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Connection storm load test for the irc server")
+
+    parser.add_argument("-c", "--clients", type=int, nargs="?",
+                        metavar="CLIENTS", default=5000,
+                        help="Number of clients reconnecting at once")
+
+    parser.add_argument("-b", "--backlog", type=int, nargs="?",
+                        metavar="BACKLOG", default=socket.SOMAXCONN,
+                        help="Length of the pending connection queue")
+
+    parser.add_argument("-m", "--max-per-ip", type=int, nargs="?",
+                        metavar="MAX_PER_IP", default=0,
+                        help="Max concurrent connections from one IP (0 for no limit)")
+
+    parser.add_argument("-t", "--timeout", type=float, nargs="?",
+                        metavar="SECONDS", default=30,
+                        help="Give up waiting for the server after this long")
+
+    args = parser.parse_args()
+    main(args)
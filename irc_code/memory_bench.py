@@ -0,0 +1,128 @@
+"""
+Per-connection memory benchmark: bytes the server holds per idle registered connection.
+
+Measured with tracemalloc, so only Python allocations count (not kernel socket buffers).
+Exits non-zero when the result goes over the budget.
+"""
+
+import gc
+import sys
+import time
+import socket
+import argparse
+import selectors
+import threading
+import tracemalloc
+import multiprocessing
+
+import irc_server
+
+COMMANDS = ('NICK bench{}', 'USER bench{0} localhost localhost :bench{0}', 'JOIN #global')
+
+def run_clients(addr, clients, pipe):
+    """
+    Client side, in its own process so its sockets do not show up in the server's tracemalloc.
+    Sends one round of commands each time the benchmark says the server is done with the last,
+    so the server never reads two commands of a client in a single recv().
+    """
+    selector = selectors.DefaultSelector()
+    conns = []
+    for i in range(clients):
+        conn = socket.create_connection(addr)
+        conns.append(conn)
+        selector.register(conn, selectors.EVENT_READ)
+
+    # Keep reading so the server's blocking send() never stalls.
+    while True:
+        while not pipe.poll():
+            drain(selector, 0.01)
+        round = pipe.recv()
+        if round is None:
+            break
+        for i, conn in enumerate(conns):
+            conn.send(bytes(COMMANDS[round].format(i), 'utf-8'))
+    for conn in conns:
+        conn.close()
+
+def drain(selector, timeout):
+    for key, _ in selector.select(timeout):
+        try:
+            key.fileobj.recv(65536)
+        except OSError:
+            pass
+
+def wait_until(condition, timeout=120):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError('server did not catch up in time')
+        time.sleep(0.01)
+
+def main(args):
+    server = irc_server.IRCServer('127.0.0.1', 0)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    wait_until(lambda: server.loop_thread_id is not None)
+    addr = ('127.0.0.1', server.server_socket.getsockname()[1])
+
+    tracemalloc.start()
+    # Warm up state the server creates on first use before taking the baseline.
+    warmup = socket.create_connection(addr)
+    wait_until(lambda: server.client_count() == 1)
+    warmup.close()
+    wait_until(lambda: server.client_count() == 0)
+    del warmup
+    # A full collection also empties the interpreter's free lists, which tracemalloc counts as used.
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+
+    pipe, client_pipe = multiprocessing.Pipe()
+    clients = multiprocessing.Process(target=run_clients, args=(addr, args.clients, client_pipe))
+    clients.start()
+    wait_until(lambda: server.client_count() == args.clients)
+    registration_done = (
+        lambda: sum(p.nickname is not None for p in list(server.pending_users.values())) == args.clients,
+        lambda: sum(p.username is not None for p in list(server.pending_users.values())) == args.clients,
+        lambda: len(server.online_users) == args.clients,
+    )
+    for round, done in enumerate(registration_done):
+        pipe.send(round)
+        wait_until(done)
+    # Let the server finish the last fan-out and go idle.
+    time.sleep(0.5)
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    pipe.send(None)
+    clients.join()
+
+    # Only count what the server allocated, not the benchmark's own bookkeeping.
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+              tracemalloc.Filter(False, multiprocessing.__path__[0] + '/*'),
+              tracemalloc.Filter(False, '<frozen importlib.*')]
+    after, before = after.filter_traces(ignore), before.filter_traces(ignore)
+    growth = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    per_connection = growth / args.clients
+    print(f'[MEMORY BENCH] {args.clients} idle registered connections: {growth} bytes, '
+          f'{per_connection:.0f} bytes per connection (budget {args.budget})')
+    if args.verbose:
+        for stat in after.compare_to(before, 'lineno')[:15]:
+            print(f'[MEMORY BENCH]   {stat}')
+    return 1 if per_connection > args.budget else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-connection memory benchmark for the irc server")
+
+    parser.add_argument("-c", "--clients", type=int, nargs="?",
+                        metavar="CLIENTS", default=1000,
+                        help="Number of idle connections to hold")
+
+    parser.add_argument("--budget", type=int, nargs="?",
+                        metavar="BYTES", default=640,
+                        help="Maximum bytes per idle connection")
+
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Show the biggest allocation sites")
+
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,243 @@
+"""
+Runtime profiling hooks for the server, toggled without a restart.
+
++ A sampling profiler that writes collapsed stacks (flamegraph.pl / speedscope input).
++ Per-handler wall time around the `handle_data` dispatch targets and `broadcast`.
++ tracemalloc snapshots.
+
+Nothing is hooked while everything is stopped, so the disabled cost is zero.
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import functools
+import tracemalloc
+from collections import Counter
+
+logger = logging.getLogger()
+
+# Server methods wrapped while handler timing is on.
+TIMED_METHODS = ('handle_NICK', 'handle_USER', 'handle_JOIN', 'handle_QUIT', 'handle_PRIVMSG', 'broadcast')
+
+# Commands file read on SIGHUP, inside the output directory.
+CONTROL_FILE = 'irc_server.control'
+
+class SamplingProfiler:
+    """ Samples the stack of one thread at a fixed interval from a background thread. """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self.stacks.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='irc-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def write_collapsed(self, path):
+        """ One `frame;frame;frame count` line per distinct stack. """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class HandlerTimer:
+    """ Accumulates call count and wall time per wrapped server method. """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.total = Counter()
+        self.worst = Counter()
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.calls[name] += 1
+                self.total[name] += elapsed
+                if elapsed > self.worst[name]:
+                    self.worst[name] = elapsed
+        return timed
+
+    def report(self):
+        lines = [f'{"handler":<16}{"calls":>10}{"total ms":>12}{"avg us":>10}{"max us":>10}']
+        for name, total in self.total.most_common():
+            calls = self.calls[name]
+            lines.append(f'{name:<16}{calls:>10}{total * 1e3:>12.2f}'
+                         f'{total / calls * 1e6:>10.1f}{self.worst[name] * 1e6:>10.1f}')
+        return '\n'.join(lines)
+
+
+class Profiler:
+    """ Profiling controls attached to an IRCServer. """
+
+    def __init__(self, server, output_dir='.'):
+        self.server = server
+        self.output_dir = output_dir
+        self.sampler = None
+        self.timer = None
+
+    def _output_path(self, prefix, ext):
+        return os.path.join(self.output_dir, f'{prefix}-{time.strftime("%Y%m%d-%H%M%S")}.{ext}')
+
+    def _announce(self, msg):
+        logger.info(f'[PROFILER] {msg}')
+        print(f'[PROFILER] {msg}')
+
+    def start_sampling(self):
+        if self.sampler is not None:
+            return
+        self.sampler = SamplingProfiler(self.server.loop_thread_id)
+        self.sampler.start()
+        self._announce('Sampling profiler started')
+
+    def stop_sampling(self):
+        if self.sampler is None:
+            return
+        self.sampler.stop()
+        path = self._output_path('profile', 'folded')
+        self.sampler.write_collapsed(path)
+        self.sampler = None
+        self._announce(f'Sampling profiler stopped, collapsed stacks written to {path}')
+
+    def toggle_sampling(self):
+        if self.sampler is None:
+            self.start_sampling()
+        else:
+            self.stop_sampling()
+
+    def start_timing(self):
+        if self.timer is not None:
+            return
+        self.timer = HandlerTimer()
+        # Shadow the class methods with timed wrappers on the instance only.
+        for name in TIMED_METHODS:
+            setattr(self.server, name, self.timer.wrap(name, getattr(self.server, name)))
+        self._announce('Handler timing started')
+
+    def stop_timing(self):
+        if self.timer is None:
+            return
+        for name in TIMED_METHODS:
+            delattr(self.server, name)
+        self._announce('Handler timing stopped\n' + self.timer.report())
+        self.timer = None
+
+    def toggle_timing(self):
+        if self.timer is None:
+            self.start_timing()
+        else:
+            self.stop_timing()
+
+    def start_tracemalloc(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self._announce('tracemalloc started')
+
+    def dump_tracemalloc(self, limit=50):
+        if not tracemalloc.is_tracing():
+            self._announce('tracemalloc is not running, use `tracemalloc start` first')
+            return
+        snapshot = tracemalloc.take_snapshot()
+        path = self._output_path('tracemalloc', 'txt')
+        current, peak = tracemalloc.get_traced_memory()
+        with open(path, 'w') as f:
+            f.write(f'current {current} bytes, peak {peak} bytes\n')
+            for stat in snapshot.statistics('lineno')[:limit]:
+                f.write(f'{stat}\n')
+        self._announce(f'tracemalloc snapshot written to {path}')
+
+    def stop_tracemalloc(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self._announce('tracemalloc stopped')
+
+    def stop_all(self):
+        self.stop_sampling()
+        self.stop_timing()
+        self.stop_tracemalloc()
+
+    """
+    Admin controls: signals and server console commands.
+    """
+
+    @property
+    def control_path(self):
+        return os.path.join(self.output_dir, CONTROL_FILE)
+
+    def install_signal_handlers(self):
+        """
+        SIGUSR1 toggles the sampling profiler, SIGUSR2 toggles handler timing, SIGHUP runs the
+        console commands written in the control file, so a server without console can be driven
+        too (e.g. `tracemalloc dump`). Main thread only.
+        """
+        if not hasattr(signal, 'SIGUSR1'):
+            logger.info('[PROFILER] Signals not available on this platform, use console commands')
+            return
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle_sampling())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggle_timing())
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.run_control_file())
+
+    def run_control_file(self):
+        """ Run every command line of the control file, then remove it. """
+        try:
+            with open(self.control_path) as f:
+                lines = f.readlines()
+            os.remove(self.control_path)
+        except OSError as e:
+            self._announce(f'No control file to run: {e}')
+            return
+        for line in lines:
+            self.handle_command(line)
+
+    def handle_command(self, line):
+        """ Format: profile start|stop, timing start|stop, tracemalloc start|dump|stop """
+        commands = {
+            'profile start': self.start_sampling,
+            'profile stop': self.stop_sampling,
+            'timing start': self.start_timing,
+            'timing stop': self.stop_timing,
+            'tracemalloc start': self.start_tracemalloc,
+            'tracemalloc dump': self.dump_tracemalloc,
+            'tracemalloc stop': self.stop_tracemalloc,
+        }
+        command = ' '.join(line.split())
+        if not command:
+            return
+        if command in commands:
+            commands[command]()
+        else:
+            self._announce(f'Unknown command {command!r}. Try: ' + ', '.join(commands))
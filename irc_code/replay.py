@@ -0,0 +1,189 @@
+"""
+Replay a traffic capture (see `capture.py`) against a running server.
+
+Opens one connection per captured client and sends the same bytes in the same order,
+at the original pace, scaled, or as fast as possible. Afterwards it checks that every
+connection received as many bytes as the server sent it during the capture (fan-out),
+and reports throughput and JOIN-to-welcome latency.
+
+Messages have no delimiter, so two commands of one client landing in a single recv() on the
+server are handled as one. The schedule keeps commands of one connection `--gap` apart for
+that, and a fan-out mismatch then means the server lost or duplicated output.
+"""
+
+import sys
+import time
+import socket
+import struct
+import argparse
+import selectors
+from collections import Counter
+
+import common
+import capture
+
+def schedule(events, speed, gap):
+    """
+    Replay time of every client event: capture time / speed (all at 0 when speed is 0),
+    with events of one connection kept at least `gap` seconds apart. Making room for the
+    gap shifts every later event too, so the capture order across connections is kept.
+    """
+    last = {}
+    shift = 0.0
+    planned = []
+    for ts, conn_id, kind, payload in events:
+        at = (ts / speed if speed else 0.0) + shift
+        if conn_id in last and at < last[conn_id] + gap:
+            shift += last[conn_id] + gap - at
+            at = last[conn_id] + gap
+        last[conn_id] = at
+        planned.append((at, conn_id, kind, payload))
+    return planned
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Replay:
+    def __init__(self, addr, expected, drain_timeout):
+        self.addr = addr
+        # Bytes the server sent each connection during the capture.
+        self.expected = expected
+        self.drain_timeout = drain_timeout
+        self.selector = selectors.DefaultSelector()
+        self.conns = {}
+        self.received = Counter()
+        self.commands = 0
+        # Registration in flight per connection: (JOIN send time, welcome text, data since JOIN).
+        self.nicknames = {}
+        self.awaiting_welcome = {}
+        self.latencies = []
+
+    def run(self, planned):
+        start = time.perf_counter()
+        for at, conn_id, kind, payload in planned:
+            while True:
+                wait = start + at - time.perf_counter()
+                self.poll(max(wait, 0))
+                if wait <= 0:
+                    break
+            self.apply(conn_id, kind, payload)
+        sent_done = time.perf_counter()
+
+        for conn_id in list(self.conns):
+            self.close(conn_id)
+        return sent_done - start
+
+    def apply(self, conn_id, kind, payload):
+        if kind == capture.CONNECT:
+            sock = socket.create_connection(self.addr)
+            self.conns[conn_id] = sock
+            self.selector.register(sock, selectors.EVENT_READ, conn_id)
+        elif kind == capture.DATA and conn_id in self.conns:
+            self.conns[conn_id].sendall(payload)
+            self.commands += 1
+            if payload.startswith(b'NICK '):
+                self.nicknames[conn_id] = payload[len('NICK '):].decode(common.ENCODE_FORMAT, 'replace')
+            elif payload.startswith(b'JOIN ') and conn_id in self.nicknames:
+                welcome = f'Welcome {self.nicknames[conn_id]} to our amazing channel'.encode(common.ENCODE_FORMAT)
+                self.awaiting_welcome[conn_id] = (time.perf_counter(), welcome, bytearray())
+        elif kind in (capture.CLOSE, capture.RESET) and conn_id in self.conns:
+            self.close(conn_id, kind == capture.RESET)
+
+    def poll(self, timeout):
+        for key, _ in self.selector.select(timeout):
+            self.read(key.data, key.fileobj)
+
+    def read(self, conn_id, sock):
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self.selector.unregister(sock)
+            return
+        self.received[conn_id] += len(data)
+        if conn_id in self.awaiting_welcome:
+            sent_at, welcome, seen = self.awaiting_welcome[conn_id]
+            seen += data
+            if welcome in seen:
+                self.latencies.append(time.perf_counter() - sent_at)
+                del self.awaiting_welcome[conn_id]
+
+    def close(self, conn_id, reset=False):
+        sock = self.conns.pop(conn_id)
+        # Wait for the fan-out still in flight to this connection, the capture says how much.
+        deadline = time.perf_counter() + self.drain_timeout
+        while (self.received[conn_id] < self.expected[conn_id] and sock in self.selector.get_map()
+               and time.perf_counter() < deadline):
+            self.poll(min(0.05, max(deadline - time.perf_counter(), 0)))
+        # Then take whatever else already arrived, read() unregisters once drained.
+        sock.setblocking(False)
+        while sock in self.selector.get_map():
+            self.read(conn_id, sock)
+        if reset:
+            # Zero linger makes close() send RST, as the captured client did.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        sock.close()
+        self.awaiting_welcome.pop(conn_id, None)
+
+
+def main(args):
+    expected = Counter()
+    events = []
+    for ts, conn_id, kind, payload in capture.read_capture(args.capture):
+        if kind == capture.SENT:
+            expected[conn_id] += payload
+        else:
+            events.append((ts, conn_id, kind, payload))
+
+    planned = schedule(events, args.speed, args.gap)
+    replay = Replay((args.server, args.port), expected, args.drain_timeout)
+    elapsed = replay.run(planned)
+
+    connections = {conn_id for _, conn_id, kind, _ in events if kind == capture.CONNECT}
+    mismatched = [c for c in sorted(connections) if replay.received[c] != expected[c]]
+
+    pace = 'max speed' if not args.speed else f'{args.speed}x speed'
+    print(f'[REPLAY] {len(connections)} connections, {replay.commands} commands in {elapsed:.3f}s at {pace} '
+          f'({replay.commands / max(elapsed, 1e-9):.0f} commands/sec)')
+    print(f'[REPLAY] fan-out: expected {sum(expected.values())} bytes, received {sum(replay.received.values())} bytes, '
+          f'{len(connections) - len(mismatched)}/{len(connections)} connections match')
+    for conn_id in mismatched[:10]:
+        print(f'[REPLAY]   connection {conn_id}: expected {expected[conn_id]} bytes, received {replay.received[conn_id]}')
+    if replay.latencies:
+        print(f'[REPLAY] JOIN to welcome latency over {len(replay.latencies)} registrations: '
+              f'p50 {percentile(replay.latencies, 50) * 1e3:.2f}ms, '
+              f'p99 {percentile(replay.latencies, 99) * 1e3:.2f}ms, '
+              f'max {max(replay.latencies) * 1e3:.2f}ms')
+    return 1 if mismatched else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against an irc server")
+
+    parser.add_argument("capture", type=str, metavar="CAPTURE_FILE",
+                        help="File written by irc_server.py --capture")
+
+    parser.add_argument("-s", "--server", type=str, nargs="?",
+                        metavar="SERVER", default="localhost",
+                        help="Target server to replay against")
+
+    parser.add_argument("-p", "--port", type=int, nargs="?",
+                        metavar="PORT", default=5050,
+                        help="Target port to use")
+
+    parser.add_argument("--speed", type=float, nargs="?",
+                        metavar="SPEED", default=1.0,
+                        help="Replay pace relative to the capture, 0 for as fast as possible")
+
+    parser.add_argument("--gap", type=float, nargs="?",
+                        metavar="SECONDS", default=0.01,
+                        help="Minimum time between two commands on the same connection")
+
+    parser.add_argument("--drain-timeout", type=float, nargs="?",
+                        metavar="SECONDS", default=5.0,
+                        help="Longest wait for a connection's expected bytes before closing it")
+
+    args = parser.parse_args()
+    sys.exit(main(args))